@@ -2,19 +2,44 @@
 # -*- coding: UTF-8 -*-
 
 import argparse
+import array
+import bisect
+import collections
+import concurrent.futures
+import contextlib
+import csv
+import io
+import errno
+import heapq
+import http.server
+import ipaddress
+import itertools
+import json
+import logging
+import select
+import selectors
 import socket
 import os
 import sys
 import struct
+import subprocess
+import tempfile
 import time
+import timeit
 import random
 import traceback # useful for exception handling
 import threading
+import zlib
+
+log = logging.getLogger('NetworkApplications')
 
 def setupArgumentParser() -> argparse.Namespace:
         parser = argparse.ArgumentParser(
             description='A collection of Network Applications developed for SCC.203.')
         parser.set_defaults(func=ICMPPing, hostname='lancaster.ac.uk')
+        parser.add_argument('--log-level', default='warning',
+                            choices=['debug', 'info', 'warning', 'error'],
+                            help='verbosity of diagnostic logging')
         subparsers = parser.add_subparsers(help='sub-command help')
         
         parser_p = subparsers.add_parser('ping', aliases=['p'], help='run ping')
@@ -25,6 +50,10 @@ def setupArgumentParser() -> argparse.Namespace:
         parser_p.add_argument('--timeout', '-t', nargs='?',
                               type=int,
                               help='maximum timeout before considering request lost')
+        parser_p.add_argument('--simulate', action='store_true',
+                              help='probe a simulated network instead of the real one')
+        parser_p.add_argument('--seed', type=int, default=0,
+                              help='random seed for the simulated network')
         parser_p.set_defaults(func=ICMPPing)
 
         parser_t = subparsers.add_parser('traceroute', aliases=['t'],
@@ -35,6 +64,10 @@ def setupArgumentParser() -> argparse.Namespace:
                               help='maximum timeout before considering request lost')
         parser_t.add_argument('--protocol', '-p', nargs='?', type=str,
                               help='protocol to send request with (UDP/ICMP)')
+        parser_t.add_argument('--simulate', action='store_true',
+                              help='probe a simulated network instead of the real one')
+        parser_t.add_argument('--seed', type=int, default=0,
+                              help='random seed for the simulated network')
         parser_t.set_defaults(func=Traceroute)
         
         parser_pt = subparsers.add_parser('paris-traceroute', aliases=['pt'],
@@ -43,8 +76,14 @@ def setupArgumentParser() -> argparse.Namespace:
         parser_pt.add_argument('hostname', type=str, help='host to traceroute towards')
         parser_pt.add_argument('--timeout', '-t', nargs='?', type=int,
                               help='maximum timeout before considering request lost')
-        parser_pt.add_argument('--protocol', '-p', nargs='?', type=str,
+        parser_pt.add_argument('--protocol', '-p', nargs='?', type=str, choices=['udp', 'icmp'],
                               help='protocol to send request with (UDP/ICMP)')
+        parser_pt.add_argument('--simulate', action='store_true',
+                              help='probe a simulated network instead of the real one')
+        parser_pt.add_argument('--seed', type=int, default=0,
+                              help='random seed for the simulated network')
+        parser_pt.add_argument('--raw-receive', action='store_true',
+                              help='receive UDP probe errors on a raw ICMP socket instead of the error queue')
         parser_pt.set_defaults(func=ParisTraceroute)
 
         parser_w = subparsers.add_parser('web', aliases=['w'], help='run web server')
@@ -59,12 +98,67 @@ def setupArgumentParser() -> argparse.Namespace:
                               help='port number to start web server listening on')
         parser_x.set_defaults(func=Proxy)
 
+        parser_c = subparsers.add_parser('campaign', aliases=['c'],
+                                         help='run a doubletree traceroute campaign')
+        parser_c.add_argument('destinations', type=str,
+                              help='file listing one destination per line')
+        parser_c.add_argument('--timeout', '-t', type=int, default=2,
+                              help='maximum timeout before considering request lost')
+        parser_c.add_argument('--protocol', '-p', type=str, default='udp', choices=['udp', 'icmp'],
+                              help='protocol to send request with (UDP/ICMP)')
+        parser_c.add_argument('--start-ttl', type=int, default=6,
+                              help='mid-path TTL to start probing from')
+        parser_c.add_argument('--max-ttl', type=int, default=30,
+                              help='largest TTL to probe forward to')
+        parser_c.add_argument('--prefix-length', type=int, default=24,
+                              help='destinations in the same prefix share stop set entries')
+        parser_c.add_argument('--concurrency', '-n', type=int, default=16,
+                              help='number of destinations traced at once')
+        parser_c.add_argument('--raw-receive', action='store_true',
+                              help='receive UDP probe errors on a raw ICMP socket instead of the error queue')
+        parser_c.add_argument('--simulate', action='store_true',
+                              help='probe a simulated network instead of the real one')
+        parser_c.add_argument('--seed', type=int, default=0,
+                              help='random seed for the simulated network')
+        parser_c.set_defaults(func=TracerouteCampaign)
+
+        for subparser in (parser_p, parser_t, parser_pt, parser_c):
+            subparser.add_argument('--format', '-f', type=str, default='text',
+                                   choices=['text', 'jsonl', 'csv', 'binary'],
+                                   help='output format for probe results')
+            subparser.add_argument('--output', '-o', type=str,
+                                   help='file to stream probe results to (default stdout)')
+
+        parser_b = subparsers.add_parser('benchmark', aliases=['b'],
+                                         help='run loopback benchmarks')
+        parser_b.add_argument('--targets', type=str, default='web,proxy,micro,probe',
+                              help='comma separated benchmarks to run (web, proxy, micro, probe)')
+        parser_b.add_argument('--connections', '-c', type=str, default='1,8,32',
+                              help='comma separated concurrent connection counts')
+        parser_b.add_argument('--sizes', '-s', type=str, default='1024,65536',
+                              help='comma separated object sizes in bytes')
+        parser_b.add_argument('--keepalive', '-k', type=str, default='off,on',
+                              help='comma separated keep-alive modes (off, on)')
+        parser_b.add_argument('--duration', '-d', type=float, default=2.0,
+                              help='seconds to drive each load scenario')
+        parser_b.add_argument('--traces', type=int, default=50,
+                              help='traces per engine for the simulated probe benchmark')
+        parser_b.add_argument('--seed', type=int, default=0,
+                              help='random seed for the simulated network')
+        parser_b.add_argument('--output', '-o', type=str, default='benchmark.json',
+                              help='file to save the JSON results to')
+        parser_b.add_argument('--compare', type=str,
+                              help='earlier JSON results to compare against')
+        parser_b.set_defaults(func=Benchmark)
+
         args = parser.parse_args()
         return args
 
 
 class NetworkApplication:
 
+    receivers = threading.local()
+
     def checksum(self, dataToChecksum: str) -> str:
         csum = 0
         countTo = (len(dataToChecksum) // 2) * 2
@@ -90,6 +184,68 @@ class NetworkApplication:
 
         return answer
 
+    def setupResults(self, args):
+        # Code running probes in-process can pass its own ResultStore as args.results
+        self.results = getattr(args, 'results', None)
+        # Per-probe text is only printed when nothing else is taking the results
+        self.printResults = self.results is None and getattr(args, 'format', 'text') == 'text'
+        if self.results is None:
+            format = getattr(args, 'format', 'text')
+            writer = None
+            if format != 'text' and getattr(args, 'stream', None) is not None:
+                writer = ResultWriter(args.stream, format)
+            elif format != 'text':
+                writer = ResultWriter(open(args.output, 'wb'), format, ownsStream=True)
+            self.results = ResultStore(writer)
+
+    def recordProbe(self, target, ttl, seq, responder, delay, reached, lost):
+        if lost:
+            self.results.add(target, ttl, seq, None, None, 0)
+        else:
+            self.results.add(target, ttl, seq, responder, delay,
+                             ResultStore.REPLIED | (ResultStore.REACHED if reached else 0))
+
+    def replyReceiver(self) -> 'ICMPReceiver':
+        # One decode buffer per thread, so concurrent probes never share it
+        try:
+            return self.receivers.receiver
+        except AttributeError:
+            self.receivers.receiver = ICMPReceiver()
+            return self.receivers.receiver
+
+    def receiveMatching(self, icmpSocket, timeout, matches) -> 'ICMPReply':
+        # A raw socket sees every ICMP packet on the host, including the answers to
+        # other concurrent probes, so skip those and keep reading until the deadline
+        deadline = self.transport.clock() + timeout
+        while True:
+            remaining = deadline - self.transport.clock()
+            if remaining <= 0:
+                raise socket.timeout('timed out')
+            icmpSocket.settimeout(remaining)
+            reply = self.replyReceiver().receive(icmpSocket)
+            if reply is not None and matches(reply):
+                return reply
+            if reply is not None:
+                log.debug('ignoring ICMP type %d from %s', reply.type, reply.address)
+
+    def errorQueueReceiver(self) -> 'ErrorQueueReceiver':
+        try:
+            return self.receivers.errorQueue
+        except AttributeError:
+            self.receivers.errorQueue = ErrorQueueReceiver()
+            return self.receivers.errorQueue
+
+    def selectTransport(self, args):
+        # Probes go through args.transport when given (e.g. from code or the benchmarks)
+        transport = getattr(args, 'transport', None)
+        if transport is None:
+            transport = SimulatedNetwork(seed=args.seed) if getattr(args, 'simulate', False) else RawSocketTransport()
+        return transport
+
+    def buildICMPEchoRequest(self, ID: int, sequence=1) -> bytes:
+        icmp_header = struct.pack("BBHHH",8,0,0,ID,sequence) #the format of the header from wireshark
+        return struct.pack("BBHHH",8,0,self.checksum(icmp_header),ID,sequence)
+
     def printOneResult(self, destinationAddress: str, packetLength: int, time: float, ttl: int, destinationHostname=''):
         if destinationHostname:
             print("%d bytes from %s (%s): ttl=%d time=%.2f ms" % (packetLength, destinationHostname, destinationAddress, ttl, time))
@@ -102,77 +258,592 @@ class NetworkApplication:
             print("rtt min/avg/max = %.2f/%.2f/%.2f ms" % (minimumDelay, averageDelay, maximumDelay))
 
     def printMultipleResults(self, ttl: int, destinationAddress: str, measurements: list, destinationHostname=''):
-        latencies = ''
-        noResponse = True
-        for rtt in measurements:
-            if rtt is not None:
-                latencies += str(round(rtt, 3))
-                latencies += ' ms  '
-                noResponse = False
-            else:
-                latencies += '* ' 
+        latencies = ''.join('* ' if rtt is None else '%s ms  ' % round(rtt, 3) for rtt in measurements)
+        noResponse = all(rtt is None for rtt in measurements)
 
         if noResponse is False:
             print("%d %s (%s) %s" % (ttl, destinationHostname, destinationAddress, latencies))
         else:
             print("%d %s" % (ttl, latencies))
 
+    def serveStats(self, tcpSocket, path) -> bool:
+        # Answer GET /__stats from loopback clients with the server's metrics
+        if path != '/__stats' or tcpSocket.getpeername()[0] not in ('127.0.0.1', '::1'):
+            return False
+        body = self.metrics.render().encode()
+        header = 'HTTP/1.0 200 OK\r\nContent-Type: text/plain; version=0.0.4\r\nContent-Length: %d\r\n\r\n' % len(body)
+        tcpSocket.sendall(header.encode() + body)
+        tcpSocket.close()
+        return True
+
+class RawSocketTransport:
+    # Probes go straight to the kernel; raw ICMP sockets need root (or CAP_NET_RAW)
+
+    def socket(self, family, type, proto=0):
+        return socket.socket(family, type, proto)
+
+    def clock(self) -> float:
+        return time.time()
+
+    def gethostbyname(self, hostname):
+        return socket.gethostbyname(hostname)
+
+    def gethostbyaddr(self, address):
+        return socket.gethostbyaddr(address)
+
+    def probeId(self, destination) -> int:
+        return random.randint(1,10000)
+
+    def waitForError(self, sock, timeout) -> bool:
+        # True once the socket's error queue has something to read
+        poller = select.poll()
+        poller.register(sock, select.POLLERR)
+        return bool(poller.poll(None if timeout is None else timeout * 1000))
+
+
+class SimulatedSocket:
+    # Socket-like endpoint handed out by SimulatedNetwork.socket()
+
+    def __init__(self, network, host, type, proto):
+        self.network = network
+        self.host = host
+        self.type = type
+        self.proto = proto
+        self.ttl = 64
+        self.timeout = None
+        self.port = None
+        self.options = {}
+        self.closed = False
+        self.inbox = collections.deque()
+        self.errors = collections.deque()
+        if type == socket.SOCK_RAW:
+            host.rawSockets.append(self)
+
+    def setsockopt(self, level, option, value):
+        if (level, option) == (socket.SOL_IP, socket.IP_TTL):
+            self.ttl = value
+        else:
+            self.options[(level, option)] = value
+
+    def settimeout(self, timeout):
+        self.timeout = timeout
+
+    def getsockname(self):
+        return (SimulatedNetwork.SOURCE, self.port or 0)
+
+    def sendto(self, data, address):
+        self.network.transmit(self, bytes(data), address)
+        return len(data)
+
+    def recvfrom(self, bufsize):
+        packet, address = self.network.receive(self)
+        return packet[:bufsize], address
+
+    def recv(self, bufsize):
+        return self.recvfrom(bufsize)[0]
+
+    def recvfrom_into(self, buffer, nbytes=0):
+        packet, address = self.network.receive(self)
+        nbytes = min(len(packet), nbytes or len(buffer))
+        buffer[:nbytes] = packet[:nbytes]
+        return nbytes, address
+
+    def recvmsg_into(self, buffers, ancbufsize=0, flags=0):
+        # Only the error queue is modelled: hand back the ICMP error the way Linux does
+        if not flags & socket.MSG_ERRQUEUE or not self.errors:
+            raise BlockingIOError(errno.EAGAIN, os.strerror(errno.EAGAIN))
+        packet, responder, at = self.errors.popleft()
+        ihl = (packet[0] & 0x0f) * 4
+        quoted = packet[ihl + 8:]
+        error = ErrorQueueReceiver.EXTENDED_ERROR.pack(errno.EHOSTUNREACH if packet[ihl] == 11 else errno.ECONNREFUSED,
+                                                       ErrorQueueReceiver.SO_EE_ORIGIN_ICMP, packet[ihl], packet[ihl + 1], 0, 0, 0)
+        offender = ErrorQueueReceiver.OFFENDER.pack(socket.AF_INET, socket.inet_aton(responder))
+        ancdata = [(socket.SOL_IP, ErrorQueueReceiver.IP_RECVERR, error + offender)]
+        if self.options.get((socket.SOL_SOCKET, ErrorQueueReceiver.SO_TIMESTAMPNS)):
+            ancdata.append((socket.SOL_SOCKET, ErrorQueueReceiver.SO_TIMESTAMPNS,
+                            ErrorQueueReceiver.TIMESPEC.pack(int(at), int(at % 1 * 1e9))))
+        nbytes = min(len(quoted), len(buffers[0]))
+        buffers[0][:nbytes] = quoted[:nbytes]
+        return nbytes, ancdata, socket.MSG_ERRQUEUE, (responder, 0)
+
+    def close(self):
+        self.closed = True
+        if self in self.host.rawSockets:
+            self.host.rawSockets.remove(self)
+
+
+class SimulatedNetwork:
+    # In-process stand-in for RawSocketTransport, for benchmarking the probing code
+    # without privileges. Every destination gets a deterministic path: a few hops
+    # shared by all destinations, then routers shared by destinations with a common
+    # /8, /16 and finally /24 prefix. Some hops fan out over `ecmpWidth` routers and
+    # the router is picked by hashing the probe's flow fields, as load balancers do.
+    # Each link adds `hopDelay` ms plus up to `jitter` ms each way and drops packets
+    # with probability `loss`; routers answer at most `rateLimit` probes per second
+    # (0 for no limit). Time is virtual and nothing sleeps. Every thread behaves as
+    # its own host with its own clock, sockets and view of router rate limits.
+    # Random draws and source ports come from per-destination state, so runs are
+    # reproducible however destinations are spread over threads, as long as each
+    # destination is probed from one thread at a time.
+
+    SOURCE = '192.0.2.1'
+
+    class Host:
+        def __init__(self):
+            self.clock = 0.0
+            self.pending = []
+            self.rawSockets = []
+            self.buckets = {}
+
+    class Flow:
+        def __init__(self, rng):
+            self.rng = rng
+            self.nextPort = 33434
+
+    def __init__(self, seed=0, sharedHops=3, minHops=8, maxHops=16, hopDelay=0.5, jitter=0.2,
+                 loss=0.0, ecmpWidth=2, ecmpProbability=0.3, rateLimit=0):
+        self.seed = seed
+        self.sharedHops = sharedHops
+        self.minHops = minHops
+        self.maxHops = maxHops
+        self.hopDelay = hopDelay
+        self.jitter = jitter
+        self.loss = loss
+        self.ecmpWidth = ecmpWidth
+        self.ecmpProbability = ecmpProbability
+        self.rateLimit = rateLimit
+        self.routes = {}
+        self.flows = {}
+        self.hosts = []
+        self.probesSent = 0
+        self.deliveries = itertools.count()
+        self.lock = threading.Lock()
+        self.local = threading.local()
+
+    def host(self):
+        try:
+            return self.local.host
+        except AttributeError:
+            self.local.host = self.Host()
+            with self.lock:
+                self.hosts.append(self.local.host)
+            return self.local.host
+
+    def elapsed(self) -> float:
+        # Simulated seconds spent probing, summed over every host (thread)
+        with self.lock:
+            return sum(host.clock for host in self.hosts)
+
+    def socket(self, family, type, proto=0):
+        return SimulatedSocket(self, self.host(), type, proto)
+
+    def clock(self) -> float:
+        return self.host().clock
+
+    def gethostbyname(self, hostname):
+        try:
+            socket.inet_aton(hostname)
+            return hostname
+        except OSError:
+            h = zlib.crc32(hostname.encode())
+            return '100.%d.%d.%d' % (64 + (h >> 16 & 63), h >> 8 & 255, h & 255 or 1)
+
+    def gethostbyaddr(self, address):
+        return ('hop-%s.sim' % address.replace('.', '-'), [], [address])
+
+    def router(self, key, ttl, branch):
+        h = zlib.crc32(('%d/%s/%d/%d' % (self.seed, key, ttl, branch)).encode())
+        return '10.%d.%d.%d' % (h >> 16 & 255, h >> 8 & 255, h & 255 or 1)
+
+    def route(self, destination):
+        # List of candidate routers for each TTL, ending with the destination itself
+        with self.lock:
+            path = self.routes.get(destination)
+        if path is not None:
+            return path
+        octets = destination.split('.')
+        length = random.Random('%d/%s' % (self.seed, '.'.join(octets[:3]))).randint(self.minHops, self.maxHops)
+        path = []
+        for ttl in range(1, length):
+            if ttl <= self.sharedHops:
+                key = ''
+            else:
+                depth = 1 if ttl < length * 0.5 else 2 if ttl < length * 0.8 else 3
+                key = '.'.join(octets[:depth])
+            rng = random.Random('%d/%s/%d' % (self.seed, key, ttl))
+            width = self.ecmpWidth if ttl > self.sharedHops and rng.random() < self.ecmpProbability else 1
+            path.append([self.router(key, ttl, branch) for branch in range(width)])
+        path.append([destination])
+        with self.lock:
+            self.routes[destination] = path
+        return path
+
+    def flow(self, destination):
+        # Random draws and source ports for probes towards one destination
+        with self.lock:
+            flow = self.flows.get(destination)
+            if flow is None:
+                flow = self.flows[destination] = self.Flow(random.Random('%d/%s' % (self.seed, destination)))
+        return flow
+
+    def probeId(self, destination) -> int:
+        # Drawn from the destination's flow, since the ID feeds the ICMP flow hash
+        return self.flow(destination).rng.randint(1,10000)
+
+    def allow(self, host, router):
+        # Token bucket per router for ICMP responses, kept per host so it runs on that host's clock
+        if not self.rateLimit:
+            return True
+        now = host.clock
+        tokens, last = host.buckets.get(router, (self.rateLimit, now))
+        tokens = min(self.rateLimit, tokens + (now - last) * self.rateLimit)
+        allowed = tokens >= 1
+        host.buckets[router] = (tokens - 1 if allowed else tokens, now)
+        return allowed
+
+    def transmit(self, sock, data, address):
+        host = sock.host
+        destination, port = address
+        with self.lock:
+            self.probesSent += 1
+        flow = self.flow(destination)
+        if sock.type == socket.SOCK_DGRAM:
+            if sock.port is None:
+                sock.port = flow.nextPort
+                flow.nextPort += 1
+            quoted = struct.pack('!HHHH', sock.port, port, 8 + len(data), 0)
+            flowKey = quoted[:4]
+            protocol = 17
+        else:
+            quoted = data[:8]
+            flowKey = data[:4]
+            protocol = 1
+        # 1. Follow the path until the TTL runs out, picking ECMP branches by flow hash
+        path = self.route(destination)
+        hops = min(sock.ttl, len(path))
+        candidates = path[hops - 1]
+        responder = candidates[zlib.crc32(flowKey + destination.encode() + bytes([hops])) % len(candidates)]
+        # 2. Lose the probe or its answer on any link, or to the router's rate limit
+        rng = flow.rng
+        if self.loss and rng.random() >= (1 - self.loss) ** (2 * hops):
+            return
+        if not self.allow(host, responder):
+            return
+        # 3. Build the answer the kernel would hand to a raw ICMP socket
+        if hops < len(path):
+            icmp = struct.pack('!BBHI', 11, 0, 0, 0)
+        elif protocol == 1:
+            icmp = struct.pack('!BBH', 0, 0, 0) + data[4:]
+        else:
+            icmp = struct.pack('!BBHI', 3, 3, 0, 0)
+        if icmp[0] != 0:
+            icmp += struct.pack('!BBHHHBBH4s4s', 0x45, 0, 20 + len(data) + (8 if protocol == 17 else 0), 0, 0,
+                                1, protocol, 0, socket.inet_aton(self.SOURCE), socket.inet_aton(destination)) + quoted
+        packet = struct.pack('!BBHHHBBH4s4s', 0x45, 0, 20 + len(icmp), 0, 0, 64 - hops, 1, 0,
+                             socket.inet_aton(responder), socket.inet_aton(self.SOURCE)) + icmp
+        rtt = 2 * hops * self.hopDelay + rng.uniform(0, 2 * hops * self.jitter)
+        prober = sock if sock.options.get((socket.SOL_IP, ErrorQueueReceiver.IP_RECVERR)) else None
+        heapq.heappush(host.pending, (host.clock + rtt / 1000, next(self.deliveries), packet, responder, prober))
+
+    def advance(self, sock, queue, timeout):
+        # Deliver due answers to every open raw socket (and ICMP errors to the error
+        # queue of the probing socket), advancing the clock until `queue` has one
+        host = sock.host
+        deadline = host.clock + timeout if timeout is not None else float('inf')
+        while not queue:
+            if not host.pending or host.pending[0][0] > deadline:
+                # a blocking socket would wait forever; give up rather than hang the simulation
+                if deadline != float('inf'):
+                    host.clock = deadline
+                return False
+            at, _, packet, responder, prober = heapq.heappop(host.pending)
+            host.clock = max(host.clock, at)
+            for raw in host.rawSockets:
+                raw.inbox.append((packet, (responder, 0)))
+            if prober is not None and not prober.closed:
+                prober.errors.append((packet, responder, at))
+        return True
+
+    def receive(self, sock):
+        if not self.advance(sock, sock.inbox, sock.timeout):
+            raise socket.timeout('timed out')
+        return sock.inbox.popleft()
+
+    def waitForError(self, sock, timeout) -> bool:
+        return self.advance(sock, sock.errors, timeout)
+
+
+class ICMPReply:
+    # Decoded ICMP packet. For errors (types 3 and 11) `id` and `sequence` come from
+    # the quoted probe: the ICMP identifier and sequence number, or the UDP source
+    # and destination ports when `protocol` is 17.
+    __slots__ = ('type', 'code', 'id', 'sequence', 'address', 'ttl', 'length', 'protocol')
+
+    def __init__(self, type, code, id, sequence, address, ttl, length, protocol):
+        self.type = type
+        self.code = code
+        self.id = id
+        self.sequence = sequence
+        self.address = address
+        self.ttl = ttl
+        self.length = length
+        self.protocol = protocol
+
+
+class ICMPReceiver:
+    # Receives raw ICMP packets into one reusable buffer and decodes them in place
+    # with precompiled Structs, taking header lengths from IHL rather than assuming
+    # 20 bytes. Only the ICMPReply record is allocated per packet.
+
+    ICMP_HEADER = struct.Struct('BBHHH') # same layout the senders pack
+    UDP_PORTS = struct.Struct('!HH')
+
+    def __init__(self, bufferSize=4096):
+        self.buffer = bytearray(bufferSize)
+        self.view = memoryview(self.buffer)
+
+    def receive(self, sock) -> ICMPReply:
+        nbytes, address = sock.recvfrom_into(self.buffer)
+        return self.decode(nbytes, address[0])
+
+    def decode(self, nbytes, address):
+        view = self.view
+        ihl = (view[0] & 0x0f) * 4
+        if nbytes < ihl + 8:
+            return None
+        type, code, checksum, ID, sequence = self.ICMP_HEADER.unpack_from(view, ihl)
+        protocol = 1
+        if (type == 3 or type == 11) and nbytes >= ihl + 28:
+            inner = ihl + 8
+            protocol = view[inner + 9]
+            quoted = inner + (view[inner] & 0x0f) * 4
+            if protocol == 17 and nbytes >= quoted + 4:
+                ID, sequence = self.UDP_PORTS.unpack_from(view, quoted)
+            elif nbytes >= quoted + 8:
+                ID, sequence = self.ICMP_HEADER.unpack_from(view, quoted)[3:]
+        return ICMPReply(type, code, ID, sequence, address, view[8], nbytes, protocol)
+
+
+class ErrorQueueReceiver:
+    # Reads ICMP errors for a UDP socket from its Linux error queue (IP_RECVERR), so
+    # UDP probing needs no raw socket or root and each probe socket gets exactly
+    # its own errors. Each error comes with the kernel's receive time (SO_TIMESTAMPNS).
+
+    IP_RECVERR = getattr(socket, 'IP_RECVERR', 11)
+    SO_TIMESTAMPNS = getattr(socket, 'SO_TIMESTAMPNS', 35)
+    SO_EE_ORIGIN_ICMP = 2
+    EXTENDED_ERROR = struct.Struct('=IBBBBII') # struct sock_extended_err
+    OFFENDER = struct.Struct('=H2x4s8x') # struct sockaddr_in that follows it
+    TIMESPEC = struct.Struct('=qq')
+
+    def __init__(self, bufferSize=512):
+        self.buffer = bytearray(bufferSize)
+
+    def enable(self, sock):
+        sock.setsockopt(socket.SOL_IP, self.IP_RECVERR, 1)
+        sock.setsockopt(socket.SOL_SOCKET, self.SO_TIMESTAMPNS, 1)
+
+    def receive(self, sock):
+        # Returns (type, code, offender address, kernel timestamp or None), or None
+        # if the queued error did not come from an ICMP message
+        nbytes, ancdata, flags, address = sock.recvmsg_into([self.buffer], 256, socket.MSG_ERRQUEUE)
+        error = None
+        received = None
+        for level, kind, data in ancdata:
+            if level == socket.SOL_IP and kind == self.IP_RECVERR:
+                _, origin, type, code, _, _, _ = self.EXTENDED_ERROR.unpack_from(data)
+                if origin == self.SO_EE_ORIGIN_ICMP:
+                    offender = self.OFFENDER.unpack_from(data, self.EXTENDED_ERROR.size)[1]
+                    error = (type, code, socket.inet_ntoa(offender))
+            elif level == socket.SOL_SOCKET and kind == self.SO_TIMESTAMPNS:
+                seconds, nanoseconds = self.TIMESPEC.unpack_from(data)
+                received = seconds + nanoseconds / 1e9
+        if error is None:
+            return None
+        return error + (received,)
+
+
+class ProbeResult:
+    # One probe: rtt_us and responder are None when nothing answered; ttl is 0 for ping
+    __slots__ = ('target', 'ttl', 'seq', 'responder', 'rtt_us', 'flags')
+
+    def __init__(self, target, ttl, seq, responder, rtt_us, flags):
+        self.target = target
+        self.ttl = ttl
+        self.seq = seq
+        self.responder = responder
+        self.rtt_us = rtt_us
+        self.flags = flags
+
+    def __repr__(self):
+        return 'ProbeResult(%r, %d, %d, %r, %r, %d)' % (self.target, self.ttl, self.seq, self.responder,
+                                                       self.rtt_us, self.flags)
+
+
+class ResultStore:
+    # Probe results kept column by column in typed arrays (IPv4 addresses as
+    # integers, RTTs in microseconds), about 16 bytes per probe. Iterating yields
+    # ProbeResult records; a ResultWriter, if given, is fed in batches as results
+    # arrive. Safe to add to from several threads.
+
+    REPLIED = 1
+    REACHED = 2
+    NO_ADDRESS = 0
+    NO_RTT = 0xffffffff
+
+    def __init__(self, writer=None, batchSize=256):
+        self.targets = array.array('I')
+        self.ttls = array.array('B')
+        self.seqs = array.array('H')
+        self.responders = array.array('I')
+        self.rtts = array.array('I')
+        self.flags = array.array('B')
+        self.writer = writer
+        self.batchSize = batchSize
+        self.count = 0 # records whose columns are all filled in
+        self.written = 0
+        self.lock = threading.Lock()
+        self.writeLock = threading.Lock() # keeps batches in order while they are written
+
+    def add(self, target, ttl, seq, responder, delay, flags):
+        # `delay` is in milliseconds, as the probing code measures it
+        target = struct.unpack('!I', socket.inet_aton(target))[0]
+        responder = struct.unpack('!I', socket.inet_aton(responder))[0] if responder else self.NO_ADDRESS
+        rtt = self.NO_RTT if delay is None else min(int(delay * 1000 + 0.5), self.NO_RTT - 1)
+        with self.lock:
+            self.targets.append(target)
+            self.ttls.append(ttl & 0xff)
+            self.seqs.append(seq & 0xffff)
+            self.responders.append(responder)
+            self.rtts.append(rtt)
+            self.flags.append(flags)
+            self.count += 1
+            due = self.writer is not None and self.count - self.written >= self.batchSize
+        if due:
+            self.flush()
+
+    def flush(self):
+        # Hand everything not yet written to the writer. The batch is copied under
+        # the lock and written outside it, so adding never waits on the stream
+        if self.writer is None:
+            return
+        with self.writeLock:
+            with self.lock:
+                start, end = self.written, self.count
+                batch = tuple(column[start:end] for column in
+                              (self.targets, self.ttls, self.seqs, self.responders, self.rtts, self.flags))
+                self.written = end
+            if end > start:
+                self.writer.write(batch)
+
+    def close(self):
+        self.flush()
+        if self.writer is not None:
+            with self.writeLock:
+                self.writer.close()
+
+    def __len__(self):
+        return self.count
+
+    def __getitem__(self, index):
+        return self.record(self.targets[index], self.ttls[index], self.seqs[index],
+                           self.responders[index], self.rtts[index], self.flags[index])
+
+    def __iter__(self):
+        return self.since(0)
+
+    def since(self, index):
+        # Results recorded from `index` on, so a caller can pick up where it left off
+        while index < len(self):
+            yield self[index]
+            index += 1
+
+    @classmethod
+    def record(cls, target, ttl, seq, responder, rtt, flags) -> ProbeResult:
+        return ProbeResult(cls.address(target), ttl, seq,
+                           cls.address(responder) if responder != cls.NO_ADDRESS else None,
+                           rtt if rtt != cls.NO_RTT else None, flags)
+
+    @staticmethod
+    def address(value):
+        return socket.inet_ntoa(struct.pack('!I', value))
+
+
+class ResultWriter:
+    # Streams ResultStore batches (one array slice per column, in COLUMNS order) to
+    # a binary stream as JSON Lines, CSV or packed records. The binary format is
+    # the magic b'PRB1' followed by one RECORD per probe: target, responder,
+    # rtt_us, seq, ttl, flags in network byte order, with 0 for no responder and
+    # 0xffffffff for no rtt.
+
+    MAGIC = b'PRB1'
+    RECORD = struct.Struct('!IIIHBB')
+    COLUMNS = ('target', 'ttl', 'seq', 'responder', 'rtt_us', 'flags')
+
+    def __init__(self, stream, format, ownsStream=False):
+        self.stream = stream
+        self.format = format
+        self.ownsStream = ownsStream
+        if format == 'binary':
+            stream.write(self.MAGIC)
+        elif format == 'csv':
+            stream.write((','.join(self.COLUMNS) + '\r\n').encode())
+
+    def write(self, batch):
+        if self.format == 'binary':
+            pack = self.RECORD.pack
+            self.stream.write(b''.join(pack(target, responder, rtt, seq, ttl, flags)
+                                       for target, ttl, seq, responder, rtt, flags in zip(*batch)))
+            return
+        rows = [ResultStore.record(*values) for values in zip(*batch)]
+        if self.format == 'jsonl':
+            text = ''.join(json.dumps({column: getattr(row, column) for column in self.COLUMNS}) + '\n'
+                           for row in rows)
+        else:
+            buffer = io.StringIO()
+            csv.writer(buffer).writerows([[getattr(row, column) for column in self.COLUMNS] for row in rows])
+            text = buffer.getvalue()
+        self.stream.write(text.encode())
+
+    def close(self):
+        self.stream.flush()
+        if self.ownsStream:
+            self.stream.close()
+
+
 class ICMPPing(NetworkApplication):
 
     def receiveOnePing(self, icmpSocket, destinationAddress, ID, timeout):
-        # 1. Wait for the socket to receive a reply
-        print(f"this is the timeout{timeout}")
-        start = time.time()
-        while True:
-            
-            try:
-                reply= icmpSocket.recv(1024)
-                break
-            
-            except socket.timeout:
-                return
-            
-        if reply:
-            
-            time_received = time.time()
-             
-
+        # 1. Wait for the socket to receive an echo reply carrying the ID of the request;
+        # the raw socket also sees our own echo request and any other ICMP traffic
+        log.debug('waiting up to %s s for echo reply %d', timeout, ID)
+        start = self.transport.clock()
+        try:
+            reply = self.receiveMatching(icmpSocket, timeout, lambda reply: reply.type == 0 and reply.id == ID)
+        except socket.timeout:
+            return
         # 2. Once received, record time of receipt, otherwise, handle a timeout
+        time_received = self.transport.clock()
         # 3. Compare the time of receipt to time of sending, producing the total network delay
         delay = (time_received - start)*1000
-        #print(f'time received IS {time_received}, time start = {start}')
-        # 4. Unpack the packet header for useful information, including the ID
-        icmp_header = reply[20:28] #the part of the reply from index 20 - 27 is where the header information is located inmc
-        type, code, checksum, p_id, seq = struct.unpack('BBHHH',icmp_header)
-            
-        # 5. Check that the ID matches between the request and reply
-        print(f"p_id = {p_id} ID = {ID}")
-        if p_id == ID:
-            #print(f'id IS {ID} and PID {p_id}')
-            return(delay)
-        # 6. Return total network delay
-        pass
+        # 4. Return total network delay
+        return(delay)
 
     def sendOnePing(self, icmpSocket, destinationAddress, ID):
-        # 1. Build ICMP header
-        
-        icmp_header = struct.pack("BBHHH",8,0,0,ID,1) #the format of the header from wireshark
-
-        # 2. Checksum ICMP packet using given function
-        my_checksum = self.checksum(icmp_header)
-        # 3. Insert checksum into packet
-        icmp_header = struct.pack("BBHHH",8,0,my_checksum,ID,1)
-        # 4. Send packet using socket
+        # 1. Build ICMP header, checksum it and insert the checksum into the packet
+        icmp_header = self.buildICMPEchoRequest(ID)
+        # 2. Send packet using socket
         icmpSocket.sendto(icmp_header,(destinationAddress,1))
-        # 5. Record time of sending
-        sending_time = time.time()
+        # 3. Record time of sending
+        sending_time = self.transport.clock()
         pass
 
     def doOnePing(self, destinationAddress, timeout):
         # 1. Create ICMP socket
-        icmp_socket = socket.socket(socket.AF_INET,socket.SOCK_RAW,socket.IPPROTO_ICMP)
+        icmp_socket = self.transport.socket(socket.AF_INET,socket.SOCK_RAW,socket.IPPROTO_ICMP)
+        icmp_socket.settimeout(timeout)
         # 2. Call sendOnePing function
-        ID = random.randint(1,10000)
+        ID = self.transport.probeId(destinationAddress)
         self.sendOnePing(icmp_socket,destinationAddress,ID)
         # 3. Call receiveOnePing function
         total_delay = self.receiveOnePing(icmp_socket,destinationAddress, ID, timeout) 
@@ -189,19 +860,26 @@ class ICMPPing(NetworkApplication):
 
     def __init__(self, args):   
         counter = 0
+        self.transport = self.selectTransport(args)
+        self.setupResults(args)
         print('Ping to: %s...' % (args.hostname))
         # 1. Look up hostname, resolving it to an IP address
-        ip_address = socket.gethostbyname(args.hostname)
+        ip_address = self.transport.gethostbyname(args.hostname)
 
         # 2. Call doOnePing function, approximately every second
         while True:
 
             time =  self.doOnePing(ip_address,1)
+            self.recordProbe(ip_address, 0, counter, ip_address, time, True, time is None)
         # 3. Print out the returned delay (and other relevant details) using the printOneResult method
-            self.printOneResult(ip_address,50,time, 150, 'lancaster.ac.uk') # Example use of printOneResult - complete as appropriate
+            if self.printResults and time is None:
+                print("Request timed out.")
+            elif self.printResults:
+                self.printOneResult(ip_address,50,time, 150, 'lancaster.ac.uk') # Example use of printOneResult - complete as appropriate
             counter+=1
             if counter == 6:
                 break
+        self.results.close()
             
 
         # 4. Continue this process until stopped
@@ -225,87 +903,45 @@ class Traceroute(NetworkApplication):
 
     def receiveOnePing(self, icmpSocket, destinationAddress, ID, timeout):
         # 1. Wait for the socket to receive a reply
-        
-        print(f"this is timeout =  {timeout}")
-        start = time.time()
-        
+        log.debug('waiting up to %s s for reply %d', timeout, ID)
+        start = self.transport.clock()
         try:
-            reply,address= icmpSocket.recvfrom(1024)
-            
-               
+            # the decoded reply carries the ID of the quoted probe for time exceeded messages
+            reply = self.receiveMatching(icmpSocket, timeout,
+                                         lambda reply: reply.protocol == 1 and reply.id == ID and reply.type in (0, 11))
         except socket.timeout:
-            print("*")
+            log.debug('no reply to probe %d', ID)
             packet_loss = True
             return(4,None,0,packet_loss)
-            
-        if reply:
-            time_received = time.time()
-             
-
-        # 2. Once received, record time of receipt, otherwise, handle a timeout
+        # 2. Once received, record time of receipt
+        time_received = self.transport.clock()
         # 3. Compare the time of receipt to time of sending, producing the total network delay
         delay = (time_received - start)*1000
-        #print(f'time received IS {time_received}, time start = {start}')
-        # 4. Unpack the packet header for useful information, including the ID
-        destination = reply[16:20]
-        destination_address = socket.inet_ntoa(destination)
-        #print(f"destination ip = {destination_address}")
-        id2= reply[52:54]
-        icmp_header = reply[20:28] #the part of the reply from index 20 - 27 is where the header information is located inmc
-        type, code, checksum, p_id, seq = struct.unpack('BBHHH',icmp_header)
-        
-        if(type ==11):
-
-            id_2,= struct.unpack('H',id2)
-
-            
-            
-
-        else:
-            id_2 = p_id
-       
-        print(f"id = {id_2} and ID = {ID}")
         packet_loss = False
-       
-        
-        if(type == 11 and id_2 == ID):
-
-            
-            
-            return(delay,address[0],0,packet_loss)
-        
-        elif type == 0:
-            return(delay,address[0],1,packet_loss)
-        print(f"this does not work")
-        pass
+        if reply.type == 11:
+            return(delay,reply.address,0,packet_loss)
+        return(delay,reply.address,1,packet_loss)
 
     def sendOnePing(self, icmpSocket, destinationAddress, ID):
-        # 1. Build ICMP header
-        
-        icmp_header = struct.pack("BBHHH",8,0,0,ID,1) #the format of the header from wireshark
-
-        # 2. Checksum ICMP packet using given function
-        my_checksum = self.checksum(icmp_header)
-        icmp_header = struct.pack("BBHHH",8,0,my_checksum,ID,1)
-        # 3. Insert checksum into packet
-        # 4. Send packet using socket        icmp_header = struct.pack("BBHHH",8,0,my_checksum,ID,1)
-
+        # 1. Build ICMP header, checksum it and insert the checksum into the packet
+        icmp_header = self.buildICMPEchoRequest(ID)
+        # 2. Send packet using socket
         icmpSocket.sendto(icmp_header,(destinationAddress,1))
-        # 5. Record time of sending
-        sending_time = time.time()
+        # 3. Record time of sending
+        sending_time = self.transport.clock()
         pass
 
     def doOnePing(self, destinationAddress, timeout, ttl):
         # 1. Create ICMP socket
         try:
 
-            icmpSocket = socket.socket(socket.AF_INET,socket.SOCK_RAW,socket.IPPROTO_ICMP)
+            icmpSocket = self.transport.socket(socket.AF_INET,socket.SOCK_RAW,socket.IPPROTO_ICMP)
             icmpSocket.setsockopt(socket.SOL_IP, socket.IP_TTL, ttl)
             icmpSocket.settimeout(timeout)
         except socket.error as e:
             raise
         # 2. Call sendOnePing function
-        ID = random.randint(1,10000)
+        ID = self.transport.probeId(destinationAddress)
         self.sendOnePing(icmpSocket,destinationAddress,ID)
         # 3. Call receiveOnePing function
         total_delay, address, info, packet_loss= self.receiveOnePing(icmpSocket,destinationAddress, ID, timeout) 
@@ -316,15 +952,8 @@ class Traceroute(NetworkApplication):
         pass
     
     def printMultipleResults(self, ttl: int, destinationAddress: str, measurements: list, destinationHostname=''):
-        latencies = ''
-        noResponse = True
-        for rtt in measurements:
-            if rtt is not None:
-                latencies += str(round(rtt, 3))
-                latencies += ' ms  '
-                noResponse = False
-            else:
-                latencies += '* ' 
+        latencies = ''.join('* ' if rtt is None else '%s ms  ' % round(rtt, 3) for rtt in measurements)
+        noResponse = all(rtt is None for rtt in measurements)
 
         if noResponse is False:
             print("%d %s (%s) %s" % (ttl, destinationHostname, destinationAddress, latencies))
@@ -337,8 +966,10 @@ class Traceroute(NetworkApplication):
 
     def __init__(self, args):
         
+        self.transport = self.selectTransport(args)
+        self.setupResults(args)
         print('Traceroute to: %s...' % (args.hostname))
-        ip_address = socket.gethostbyname(args.hostname)
+        ip_address = self.transport.gethostbyname(args.hostname)
         
         # 2. Create ICMP socket
         
@@ -354,8 +985,9 @@ class Traceroute(NetworkApplication):
                 try:
 
                     times,address,info,packet_loss= self.doOnePing(ip_address,args.timeout,ttl)
-                    #address_name = socket.gethostbyaddr(address)
+                    self.recordProbe(ip_address, ttl, i, address, times, info == 1, packet_loss)
                 except TypeError:
+                    self.recordProbe(ip_address, ttl, i, None, None, False, True)
                     times = 0
                     adress = None
 
@@ -366,18 +998,18 @@ class Traceroute(NetworkApplication):
                 #
                 #self.printOneResult(address,50,times,ttl,address)
             
-            print(f"address = {address}")   
+            log.debug('hop %d answered by %s', ttl, address)
             if times == None:
                 
-                print("*******")
+                log.debug('no reply at ttl %d', ttl)
             try:
-                address_name = socket.gethostbyaddr(address)
+                address_name = self.transport.gethostbyaddr(address)
                 name_final = address_name[0]
             except:
                 
                 name_final = None      
             if info ==1:
-                name_final = socket.gethostbyaddr(ip_address)[0]
+                name_final = self.transport.gethostbyaddr(ip_address)[0]
 
             counter1 = 0
              
@@ -392,10 +1024,12 @@ class Traceroute(NetworkApplication):
             average_delay = sum(results)/len(results)  
             
 
-            self.printMultipleResults(ttl,address,results,name_final)
-            self.printAdditionalDetails(packetloss,min_delay,average_delay,max_delay)
+            if self.printResults:
+                self.printMultipleResults(ttl,address,results,name_final)
+                self.printAdditionalDetails(packetloss,min_delay,average_delay,max_delay)
             if address == ip_address:
                 break
+        self.results.close()
             
             
             
@@ -403,12 +1037,14 @@ class Traceroute(NetworkApplication):
                 
 
 class ParisTraceroute(NetworkApplication):
+
+    PROBE_PORT = 33456 # fixed UDP destination port, so every probe of a trace hashes to the same flow
     
     def sendOnePing(self, udpSocket, destinationAddress, ID):
         # 1. Build UDP
         packetData = ID.to_bytes(2,'big')
         sPort = 33457
-        dPort = 33456
+        dPort = self.PROBE_PORT
         
         #length = 8 + (len(packetData))
         #checksum = 0
@@ -422,24 +1058,17 @@ class ParisTraceroute(NetworkApplication):
 
         udpSocket.sendto(packetData,(destinationAddress,dPort))
         # 5. Record time of sending
-        sending_time = time.time()
+        sending_time = self.transport.clock()
         pass
 
     def sendOnePingICMP(self, icmpSocket, destinationAddress, ID):
 
-        # 1. Build ICMP header
-        
-        icmp_header = struct.pack("BBHHH",8,0,0,ID,1) #the format of the header from wireshark
-
-        # 2. Checksum ICMP packet using given function
-        my_checksum = self.checksum(icmp_header)
-        icmp_header = struct.pack("BBHHH",8,0,my_checksum,ID,1)
-        # 3. Insert checksum into packet
-        # 4. Send packet using socket        icmp_header = struct.pack("BBHHH",8,0,my_checksum,ID,1)
-
+        # 1. Build ICMP header, checksum it and insert the checksum into the packet
+        icmp_header = self.buildICMPEchoRequest(ID)
+        # 2. Send packet using socket
         icmpSocket.sendto(icmp_header,(destinationAddress,1))
-        # 5. Record time of sending
-        sending_time = time.time()
+        # 3. Record time of sending
+        sending_time = self.transport.clock()
         pass
 
     def doOnePing(self, destinationAddress, timeout, ttl, protocol):
@@ -448,178 +1077,117 @@ class ParisTraceroute(NetworkApplication):
 
             try:
 
-                udpSocket = socket.socket(socket.AF_INET,socket.SOCK_DGRAM,socket.IPPROTO_UDP)
+                udpSocket = self.transport.socket(socket.AF_INET,socket.SOCK_DGRAM,socket.IPPROTO_UDP)
                 udpSocket.setsockopt(socket.SOL_IP, socket.IP_TTL, ttl)
-                #udpSocket.settimeout(timeout)
+                if self.useErrorQueue:
+                    self.errorQueueReceiver().enable(udpSocket)
+                    icmpSocket = None
+                else:
+                    # open the raw socket before sending so a fast reply is not missed
+                    icmpSocket = self.transport.socket(socket.AF_INET,socket.SOCK_RAW,socket.IPPROTO_ICMP)
             except socket.error as e:
                 raise
             # 2. Call sendOnePing function
-            ID = random.randint(1,10000)
-            
+            ID = self.transport.probeId(destinationAddress)
+            sent = self.transport.clock()
             self.sendOnePing(udpSocket,destinationAddress,ID)
             # 3. Call receiveOnePing function
-            total_delay,address,info,packet_loss= self.receiveOnePing(destinationAddress, ID, timeout) 
-            # 4. Close ICMP socket
-            udpSocket.close()
+            try:
+                if self.useErrorQueue:
+                    total_delay,address,info,packet_loss= self.receiveOnePingError(udpSocket, sent, timeout)
+                else:
+                    sourcePort = udpSocket.getsockname()[1]
+                    total_delay,address,info,packet_loss= self.receiveOnePing(icmpSocket, destinationAddress, sourcePort, timeout)
+            finally:
+                # 4. Close UDP socket
+                udpSocket.close()
+                if icmpSocket is not None:
+                    icmpSocket.close()
             # 5. Return total network delay
             return total_delay,address,info,packet_loss
             pass
         elif protocol == 'icmp':
             try:
 
-                icmpSocket = socket.socket(socket.AF_INET,socket.SOCK_RAW,socket.IPPROTO_ICMP)
+                icmpSocket = self.transport.socket(socket.AF_INET,socket.SOCK_RAW,socket.IPPROTO_ICMP)
                 icmpSocket.setsockopt(socket.SOL_IP, socket.IP_TTL, ttl)
                 icmpSocket.settimeout(timeout)
             except socket.error as e:
                 raise
         # 2. Call sendOnePing function
-            ID = random.randint(1,10000)
-            self.sendOnePingICMP(icmpSocket,destinationAddress,ID)
-            # 3. Call receiveOnePing function
-            total_delay, address, info, packet_loss= self.receiveOnePingICMP(destinationAddress, ID, timeout) 
-            # 4. Close ICMP socket
-            icmpSocket.close()
+            ID = self.transport.probeId(destinationAddress)
+            try:
+                self.sendOnePingICMP(icmpSocket,destinationAddress,ID)
+                # 3. Call receiveOnePing function
+                total_delay, address, info, packet_loss= self.receiveOnePingICMP(icmpSocket, destinationAddress, ID, timeout)
+            finally:
+                # 4. Close ICMP socket
+                icmpSocket.close()
             # 5. Return total network delay
             return total_delay,address,info,packet_loss
             pass
     
 
-    def receiveOnePingICMP(self, destinationAddress, ID, timeout):
-        # 1. Wait for the socket to receive a reply
-        try:
-
-            icmpSocket = socket.socket(socket.AF_INET,socket.SOCK_RAW,socket.IPPROTO_ICMP)
-            #icmpSocket.setsockotp(socket.SOL_IP, socket.IP_TTL, ttl)
-            icmpSocket.settimeout(timeout)
-            
-        except socket.error as e:
-            raise
-        
-        start = time.time()
-        
+    def receiveReply(self, icmpSocket, timeout, matches):
+        # 1. Wait for this probe's reply on a raw ICMP socket, which sees every ICMP packet for the host
+        start = self.transport.clock()
         try:
-            reply,address= icmpSocket.recvfrom(4080)
-            
-               
+            reply = self.receiveMatching(icmpSocket, timeout, matches)
         except socket.timeout:
-            print("***")
+            log.debug('no reply within %s s', timeout)
+            return None, None
+        # 2. Once received, record time of receipt
+        # 3. Compare the time of receipt to time of sending, producing the total network delay
+        delay = (self.transport.clock() - start)*1000
+        return delay, reply
+
+    def receiveOnePingICMP(self, icmpSocket, destinationAddress, ID, timeout):
+        # 4. The decoded reply carries the ID of the quoted probe for time exceeded messages
+        delay, reply = self.receiveReply(icmpSocket, timeout,
+                                         lambda reply: reply.protocol == 1 and reply.id == ID and reply.type in (0, 11))
+        if delay is None:
             packet_loss = True
             return(4, None,0,packet_loss)
-            
-        if reply:
-            time_received = time.time()
-
-        
-
-
         packet_loss = False
-        # 2. Once received, record time of receipt, otherwise, handle a timeout
-        # 3. Compare the time of receipt to time of sending, producing the total network delay
-        delay = (time_received - start)*1000
-        #print(f'time received IS {time_received}, time start = {start}')
-        # 4. Unpack the packet header for useful information, including the ID
-        #destination = reply[16:20]
-        #destination_address = socket.inet_ntoa(destination)
-        #print(f"destination ip = {destination_address}")
-       
-        id2= reply[52:54]
-        icmp_header = reply[20:28] #the part of the reply from index 20 - 27 is where the header information is located inmc
-        type, code, checksum, p_id, seq = struct.unpack('BBHHH',icmp_header)
-        
-        if(type ==11):
-
-            id_2,= struct.unpack('H',id2)
-
-            
-            
-
-        else:
-            id_2 = p_id
-       
-        print(f"id = {id_2} and ID = {ID}")
+        if reply.type == 11:
+            return(delay,reply.address,0,packet_loss)
+        return(delay,reply.address,1,packet_loss)
+
+    def receiveOnePingError(self, udpSocket, sent, timeout):
+        # 1. Wait for the kernel to queue the ICMP error this probe triggered
+        if not self.transport.waitForError(udpSocket, timeout):
+            log.debug('no error queued within %s s', timeout)
+            packet_loss = True
+            return(4, None,0,packet_loss)
+        error = self.errorQueueReceiver().receive(udpSocket)
+        if error is None or error[0] not in (3, 11):
+            log.debug('ignoring queued error %r', error)
+            packet_loss = True
+            return(4, None,0,packet_loss)
+        type, code, address, received = error
+        # 2. Prefer the kernel's receive timestamp over reading the clock now
+        if received is None:
+            received = self.transport.clock()
+        delay = (received - sent)*1000
         packet_loss = False
-       
-        
-        if(type == 11 and id_2 == ID):
-
-            
-            
-            return(delay,address[0],0,packet_loss)
-        
-        elif type == 0:
-            return(delay,address[0],1,packet_loss)
-        print(f"this does not work")
-        pass
-        
-       
-        
-        
-
-
-            
-    def receiveOnePing(self, destinationAddress, ID, timeout):
-        # 1. Wait for the socket to receive a reply
-        try:
-
-            icmpSocket = socket.socket(socket.AF_INET,socket.SOCK_RAW,socket.IPPROTO_ICMP)
-            #icmpSocket.setsockotp(socket.SOL_IP, socket.IP_TTL, ttl)
-            icmpSocket.settimeout(timeout)
-            
-        except socket.error as e:
-            raise
-        
-        start = time.time()
-        
-        try:
-            reply,address= icmpSocket.recvfrom(4080)
-            
-               
-        except socket.timeout:
-            print("***")
+        # 3. Only port unreachable comes from the destination; other unreachables come from routers on the way
+        return(delay,address,1 if type == 3 and code == 3 else 0,packet_loss)
+
+    def receiveOnePing(self, icmpSocket, destinationAddress, sourcePort, timeout):
+        # 4. Errors quote the probe's UDP header, so match on its source and destination ports
+        delay, reply = self.receiveReply(icmpSocket, timeout,
+                                         lambda reply: reply.protocol == 17 and reply.id == sourcePort
+                                         and reply.sequence == self.PROBE_PORT and reply.type in (3, 11))
+        if delay is None:
             packet_loss = True
             return(4, None,0,packet_loss)
-            
-        if reply:
-            time_received = time.time()
-
-        
-
-
         packet_loss = False
-        # 2. Once received, record time of receipt, otherwise, handle a timeout
-        # 3. Compare the time of receipt to time of sending, producing the total network delay
-        delay = (time_received - start)*1000
-        #print(f'time received IS {time_received}, time start = {start}')
-        # 4. Unpack the packet header for useful information, including the ID
-        #destination = reply[16:20]
-        #destination_address = socket.inet_ntoa(destination)
-        #print(f"destination ip = {destination_address}")
-        icmp_header = reply[20:28] #the part of the reply from index 20 - 27 is where the header information is located inmc
-        type, code, checksum, p_id, seq = struct.unpack('BBHHH',icmp_header)
-        
-        
-       
-        
-        if(type == 11):
-            
-            
-            return(delay,address[0],0,packet_loss)
-        
-        elif type == 0 or type == 3:
-            return(delay,address[0],1,packet_loss)
-        
-        pass
+        # only port unreachable comes from the destination; other unreachables come from routers on the way
+        return(delay,reply.address,1 if reply.type == 3 and reply.code == 3 else 0,packet_loss)
 
     def printMultipleResults(self, ttl: int, destinationAddress: str, measurements: list, destinationHostname=''):
-        latencies = ''
-        noResponse = True
-        for rtt in measurements:
-            if rtt is not None:
-                latencies += str(round(rtt, 3))
-                latencies += ' ms  '
-                noResponse = False
-            else:
-                latencies += '* ' 
+        latencies = ''.join('* ' if rtt is None else '%s ms  ' % round(rtt, 3) for rtt in measurements)
+        noResponse = all(rtt is None for rtt in measurements)
 
         if noResponse is False:
             print("%d %s (%s) %s" % (ttl, destinationHostname, destinationAddress, latencies))
@@ -628,9 +1196,13 @@ class ParisTraceroute(NetworkApplication):
 
     def __init__(self, args):
         
+        self.transport = self.selectTransport(args)
+        self.setupResults(args)
+        # Linux reports UDP probe errors on the probe socket itself, no raw socket needed
+        self.useErrorQueue = sys.platform.startswith('linux') and not getattr(args, 'raw_receive', False)
         print('Paris raceroute to: %s...' % (args.hostname))
-        ip_address = socket.gethostbyname(args.hostname)
-        print(f"protocol = {args.protocol}")
+        ip_address = self.transport.gethostbyname(args.hostname)
+        log.debug('protocol = %s', args.protocol)
         # 2. Create ICMP socket
         
 
@@ -645,11 +1217,14 @@ class ParisTraceroute(NetworkApplication):
                 try:
 
                     times,address,info,packet_loss= self.doOnePing(ip_address,args.timeout,ttl,args.protocol)
-                    #address_name = socket.gethostbyaddr(address)
+                    self.recordProbe(ip_address, ttl, i, address, times, info == 1, packet_loss)
                 except TypeError:
-                    print("type error")
+                    self.recordProbe(ip_address, ttl, i, None, None, False, True)
+                    log.debug('unmatched reply at ttl %d', ttl)
                     times = 0
                     adress = None
+                    info = 0
+                    packet_loss = True
 
 
                 #print(f"ip_address = {address}, ")
@@ -661,15 +1236,15 @@ class ParisTraceroute(NetworkApplication):
                
             if times == None:
                 
-                print("*******")
+                log.debug('no reply at ttl %d', ttl)
             try:
-                address_name = socket.gethostbyaddr(address)
+                address_name = self.transport.gethostbyaddr(address)
                 name_final = address_name[0]
             except:
                 
                 name_final = None      
             if info ==1:
-                name_final = socket.gethostbyaddr(ip_address)[0]
+                name_final = self.transport.gethostbyaddr(ip_address)[0]
 
             counter1 = 0
              
@@ -684,10 +1259,12 @@ class ParisTraceroute(NetworkApplication):
             average_delay = sum(results)/len(results)  
             
 
-            self.printMultipleResults(ttl,address,results,name_final)
-            self.printAdditionalDetails(packetloss,min_delay,average_delay,max_delay)
+            if self.printResults:
+                self.printMultipleResults(ttl,address,results,name_final)
+                self.printAdditionalDetails(packetloss,min_delay,average_delay,max_delay)
             if address == ip_address:
                 break
+        self.results.close()
             
             
 
@@ -698,100 +1275,469 @@ class ParisTraceroute(NetworkApplication):
 
 
 
+class TracerouteCampaign(ParisTraceroute):
+    # Doubletree: trace many destinations, starting each at a mid-path TTL. Probing
+    # forward stops at an (interface, destination prefix) pair any trace has already
+    # found (the global stop set); probing backward stops at an interface this
+    # monitor has already seen (the local stop set), since the path to it is known.
+    # Replies are matched to their probe (by socket, UDP ports or ICMP ID), so
+    # traces can run concurrently in either mode.
+
+    attempts = 2 # probes per hop before giving up on it
+    gapLimit = 3 # unanswered hops in a row before giving up going forward
+
+    def probeHop(self, destination, ttl):
+        # Returns (delay, address, reached destination), address None if nothing answered
+        for attempt in range(self.attempts):
+            with self.lock:
+                self.probes += 1
+            try:
+                delay, address, info, packet_loss = self.doOnePing(destination, self.timeout, ttl, self.protocol)
+            except TypeError:
+                self.recordProbe(destination, ttl, attempt, None, None, False, True)
+                continue
+            self.recordProbe(destination, ttl, attempt, address, delay, info == 1 or address == destination, packet_loss)
+            if not packet_loss:
+                return delay, address, info == 1 or address == destination
+        return None, None, False
+
+    def traceDestination(self, destination):
+        prefix = str(ipaddress.ip_network('%s/%d' % (destination, self.prefixLength), strict=False))
+        hops = {}
+        # 1. Probe forward until the destination answers or the path reaches known territory
+        ttl = self.startTtl
+        silent = 0
+        while ttl <= self.maxTtl and silent < self.gapLimit:
+            delay, address, reached = self.probeHop(destination, ttl)
+            hops[ttl] = (address, delay)
+            if reached:
+                break
+            if address is None:
+                silent += 1
+            else:
+                silent = 0
+                with self.lock:
+                    known = (address, prefix) in self.globalStopSet
+                    self.globalStopSet.add((address, prefix))
+                if known:
+                    break
+            ttl += 1
+        # 2. Probe backward until reaching an interface an earlier trace went through
+        ttl = self.startTtl - 1
+        while ttl >= 1:
+            delay, address, reached = self.probeHop(destination, ttl)
+            if reached:
+                # the destination is closer than the start TTL
+                hops = {hop: result for hop, result in hops.items() if hop < ttl}
+            hops[ttl] = (address, delay)
+            if address is not None and not reached:
+                with self.lock:
+                    known = address in self.localStopSet
+                    self.localStopSet.add(address)
+                if known:
+                    break
+            ttl -= 1
+        return destination, hops
+
+    def printTrace(self, destination, hops):
+        lines = ['Trace to %s:' % destination]
+        for ttl in sorted(hops):
+            address, delay = hops[ttl]
+            if address is None:
+                lines.append('%2d  *' % ttl)
+            else:
+                lines.append('%2d  %-15s %.3f ms' % (ttl, address, delay))
+        print('\n'.join(lines))
+
+    def readDestinations(self, path):
+        names = []
+        with open(path) as f:
+            for line in f:
+                name = line.split('#', 1)[0].strip()
+                if name:
+                    names.append(name)
+        return names
+
+    def traceName(self, name):
+        # Resolved on the pool as well, so lookups overlap with other traces
+        try:
+            destination = self.transport.gethostbyname(name)
+        except OSError as e:
+            return name, e
+        return self.traceDestination(destination)
+
+    def __init__(self, args):
+        self.transport = self.selectTransport(args)
+        self.setupResults(args)
+        self.useErrorQueue = sys.platform.startswith('linux') and not getattr(args, 'raw_receive', False)
+        self.timeout = args.timeout
+        self.protocol = args.protocol.lower()
+        self.startTtl = args.start_ttl
+        self.maxTtl = args.max_ttl
+        self.prefixLength = args.prefix_length
+        self.lock = threading.Lock()
+        self.globalStopSet = set()
+        self.localStopSet = set()
+        self.probes = 0
+
+        names = self.readDestinations(args.destinations)
+        print('Doubletree campaign to %d destinations...' % len(names))
+        start = time.perf_counter()
+        traced = 0
+        with concurrent.futures.ThreadPoolExecutor(max_workers=args.concurrency) as pool:
+            for destination, hops in pool.map(self.traceName, names):
+                if isinstance(hops, OSError):
+                    print('Skipping %s: %s' % (destination, hops))
+                    continue
+                traced += 1
+                if self.printResults:
+                    self.printTrace(destination, hops)
+        self.results.close()
+        elapsed = time.perf_counter() - start
+        print('%d destinations, %d probes (%.1f per destination) in %.2f s'
+              % (traced, self.probes, self.probes / max(traced, 1), elapsed))
+
+
+class Metrics:
+    # Counters, gauges and latency histograms for the servers, rendered in Prometheus
+    # text format. Each thread updates one of a few lock-striped shards, so handler
+    # threads rarely contend; render() folds the shards together.
+
+    BUCKETS = (0.0001, 0.00025, 0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025,
+               0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+
+    def __init__(self, prefix, shards=8):
+        self.prefix = prefix
+        self.kinds = {}
+        self.kindsLock = threading.Lock()
+        self.shards = [(threading.Lock(), collections.Counter(), {}) for i in range(shards)]
+        self.nextShard = itertools.count()
+        self.local = threading.local()
+
+    def shard(self):
+        try:
+            return self.local.shard
+        except AttributeError:
+            self.local.shard = self.shards[next(self.nextShard) % len(self.shards)]
+            return self.local.shard
+
+    def declare(self, name, kind):
+        if name not in self.kinds:
+            with self.kindsLock:
+                self.kinds.setdefault(name, kind)
+
+    def inc(self, name, value=1):
+        self.declare(name, 'counter')
+        lock, counters, histograms = self.shard()
+        with lock:
+            counters[name] += value
+
+    def add(self, name, delta):
+        self.declare(name, 'gauge')
+        lock, counters, histograms = self.shard()
+        with lock:
+            counters[name] += delta
+
+    def observe(self, name, seconds):
+        self.declare(name, 'histogram')
+        index = bisect.bisect_left(self.BUCKETS, seconds)
+        lock, counters, histograms = self.shard()
+        with lock:
+            histogram = histograms.get(name)
+            if histogram is None:
+                histogram = histograms[name] = [[0] * (len(self.BUCKETS) + 1), 0.0]
+            histogram[0][index] += 1
+            histogram[1] += seconds
+
+    def snapshot(self):
+        counters = collections.Counter()
+        histograms = {}
+        for lock, shardCounters, shardHistograms in self.shards:
+            with lock:
+                counters.update(shardCounters)
+                for name, (buckets, total) in shardHistograms.items():
+                    merged = histograms.setdefault(name, [[0] * len(buckets), 0.0])
+                    merged[0] = [a + b for a, b in zip(merged[0], buckets)]
+                    merged[1] += total
+        return counters, histograms
+
+    def render(self) -> str:
+        counters, histograms = self.snapshot()
+        with self.kindsLock:
+            kinds = sorted(self.kinds.items())
+        lines = []
+        for name, kind in kinds:
+            metric = '%s_%s' % (self.prefix, name)
+            lines.append('# TYPE %s %s' % (metric, kind))
+            if kind != 'histogram':
+                lines.append('%s %s' % (metric, counters[name]))
+                continue
+            buckets, total = histograms.get(name, [[0] * (len(self.BUCKETS) + 1), 0.0])
+            cumulative = 0
+            for bound, count in zip(self.BUCKETS + ('+Inf',), buckets):
+                cumulative += count
+                lines.append('%s_bucket{le="%s"} %d' % (metric, bound, cumulative))
+            lines.append('%s_sum %.6f' % (metric, total))
+            lines.append('%s_count %d' % (metric, cumulative))
+        return '\n'.join(lines) + '\n'
+
+
 class WebServer(NetworkApplication):
 
-    def handleRequest(self,tcpSocket):
-        print("wrong 1")
-        # 1. Receive request message from the client on connection socket
-        client_request = tcpSocket.recv(10000) #1024 because that is the maximum amount of bytes of data that can be received by the socket
-        
-        # 2. Extract the path of the requested object from the message (second part of the HTTP header)
-        request_parse = client_request.split()[1]
-        
-        # 3. Read the corresponding file from disk
-        f = open(request_parse[1:])
-        # 4. Store in temporary buffer
-        response = f.read()
-        f.close()
-        # 5. Send the correct HTTP response error
-        encodedTxt = 'HTTP/1.0 200 OK\r\n\r\n'.encode()
-        tcpSocket.send(encodedTxt)
-        # 6. Send the content of the file to the socket
-        print("wrong2")
-        #for i in range (0,len(response)):
-
-        response = response.encode()
-
-        tcpSocket.send(response)
-        # 7. Close the connection socket
-        tcpSocket.close()
-        #pass
+    def handleRequest(self,tcpSocket,accepted):
+        start = time.perf_counter()
+        self.metrics.observe('accept_seconds', start - accepted)
+        self.metrics.add('active_connections', 1)
+        try:
+            # 1. Receive request message from the client on connection socket
+            client_request = tcpSocket.recv(10000) #1024 because that is the maximum amount of bytes of data that can be received by the socket
+            self.metrics.inc('bytes_received_total', len(client_request))
+
+            # 2. Extract the path of the requested object from the message (second part of the HTTP header)
+            request_parse = client_request.split()[1]
+            self.metrics.observe('parse_seconds', time.perf_counter() - start)
+            self.metrics.inc('requests_total')
+            log.debug('request for %s', request_parse)
+            if self.serveStats(tcpSocket, request_parse.decode()):
+                return
+
+            # 3. Read the corresponding file from disk
+            f = open(request_parse[1:])
+            # 4. Store in temporary buffer
+            response = f.read()
+            f.close()
+            # 5. Send the correct HTTP response error
+            encodedTxt = 'HTTP/1.0 200 OK\r\n\r\n'.encode()
+            tcpSocket.send(encodedTxt)
+            self.metrics.observe('ttfb_seconds', time.perf_counter() - start)
+            # 6. Send the content of the file to the socket
+            response = response.encode()
+
+            tcpSocket.sendall(response)
+            self.metrics.inc('bytes_sent_total', len(encodedTxt) + len(response))
+            # 7. Close the connection socket
+            tcpSocket.close()
+        finally:
+            self.metrics.add('active_connections', -1)
+            self.metrics.observe('request_seconds', time.perf_counter() - start)
 
     def __init__(self, args):
         print('Web Server starting on port: %i...' % (args.port))
+        self.metrics = Metrics('webserver')
         # 1. Create server socket
-       
-
         ServerSocket = socket.socket(socket.AF_INET,socket.SOCK_STREAM)
-            #print("erorr")
-            # 2. Bind the server socket to server address and server port
+        # 2. Bind the server socket to server address and server port
         serverAddress = ("localhost")
         ServerSocket.bind((serverAddress,args.port))
-            # 3. Continuously listen for connections to server socket
+        # 3. Continuously listen for connections to server socket
         ServerSocket.listen(1)
         while True:
-            print("erorr")
             Socket,address = ServerSocket.accept()
-            print("errorrrrrr")
-            self.handleRequest(Socket)
-            print("errorrrrrr2")
-        # 4. When a connection is accepted, call handleRequest function, passing new connection socket (see https://docs.python.org/3/library/socket.html#socket.socket.accept)
+            accepted = time.perf_counter()
+            log.debug('accepted connection from %s:%d', *address)
+            # 4. When a connection is accepted, call handleRequest function, passing new connection socket (see https://docs.python.org/3/library/socket.html#socket.socket.accept)
+            self.handleRequest(Socket, accepted)
         # 5. Close server socket
         ServerSocket.close()
-       
 
 
+class DNSResolver:
+    # Caching resolver used by the proxy so repeat origins skip the system resolver.
+    # Positive answers live for `ttl` seconds and may be served stale for another
+    # `staleTtl` seconds while a refresh runs in the background; failures are cached
+    # for `negativeTtl` seconds. Lookups run on a small pool and concurrent requests
+    # for the same origin share one lookup.
+
+    def __init__(self, maxEntries=256, ttl=300.0, staleTtl=60.0, negativeTtl=30.0, workers=4, attemptDelay=0.25, metrics=None):
+        self.metrics = metrics
+        self.maxEntries = maxEntries
+        self.ttl = ttl
+        self.staleTtl = staleTtl
+        self.negativeTtl = negativeTtl
+        self.attemptDelay = attemptDelay
+        self.entries = collections.OrderedDict() # (host, port) -> (expiry, addresses or (error type, args))
+        self.inFlight = {}
+        self.lock = threading.Lock()
+        self.pool = concurrent.futures.ThreadPoolExecutor(max_workers=workers, thread_name_prefix='dns')
+
+    def lookup(self, host, port):
+        key = (host, port)
+        result = None
+        try:
+            infos = socket.getaddrinfo(host, port, 0, socket.SOCK_STREAM)
+            result = [(family, sockaddr) for family, _, _, _, sockaddr in infos]
+            expiry = time.monotonic() + self.ttl
+        except (socket.gaierror, UnicodeError) as e:
+            # cache the error type and arguments; a fresh exception is raised on each hit
+            result = (type(e), e.args)
+            expiry = time.monotonic() + self.negativeTtl
+        finally:
+            with self.lock:
+                stale = self.entries.get(key)
+                if isinstance(result, tuple) and stale is not None and isinstance(stale[1], list):
+                    # a failed refresh keeps serving the stale addresses until they run out
+                    pass
+                elif result is not None:
+                    self.entries[key] = (expiry, result)
+                    self.entries.move_to_end(key)
+                    while len(self.entries) > self.maxEntries:
+                        self.entries.popitem(last=False)
+                        if self.metrics is not None:
+                            self.metrics.inc('dns_cache_evictions_total')
+                self.inFlight.pop(key, None)
+        return result
+
+    def resolve(self, host, port):
+        # 1. Serve from the cache while the entry is fresh (or stale but refreshing)
+        key = (host, port)
+        now = time.monotonic()
+        with self.lock:
+            entry = self.entries.get(key)
+            future = None
+            if entry is not None:
+                expiry, result = entry
+                if now < expiry:
+                    self.entries.move_to_end(key)
+                elif isinstance(result, list) and now < expiry + self.staleTtl:
+                    if key not in self.inFlight:
+                        self.inFlight[key] = self.pool.submit(self.lookup, host, port)
+                else:
+                    del self.entries[key]
+                    entry = None
+            # 2. Otherwise join the lookup already running for this origin, or start one
+            if entry is None:
+                future = self.inFlight.get(key)
+                if future is None:
+                    future = self.pool.submit(self.lookup, host, port)
+                    self.inFlight[key] = future
+        if self.metrics is not None:
+            self.metrics.inc('dns_cache_misses_total' if future is not None else 'dns_cache_hits_total')
+        if future is not None:
+            result = future.result()
+        if isinstance(result, tuple):
+            errorType, errorArgs = result
+            raise errorType(*errorArgs)
+        return result
+
+    def interleave(self, addresses):
+        # Alternate address families so a broken family only costs one attempt delay (RFC 8305)
+        byFamily = collections.OrderedDict()
+        for family, sockaddr in addresses:
+            byFamily.setdefault(family, []).append((family, sockaddr))
+        ordered = []
+        queues = list(byFamily.values())
+        while queues:
+            for queue in queues:
+                ordered.append(queue.pop(0))
+            queues = [queue for queue in queues if queue]
+        return ordered
+
+    def openConnection(self, host, port, timeout):
+        # Race connection attempts, starting the next address every `attemptDelay`
+        # seconds (or as soon as one fails), and keep whichever connects first.
+        candidates = self.interleave(self.resolve(host, port))
+        pending = {}
+        lastError = None
+        deadline = time.monotonic() + timeout
+        nextAttempt = 0.0
+        # a selector rather than select.select, which fails on descriptors above 1023
+        selector = selectors.DefaultSelector()
+        try:
+            while candidates or pending:
+                now = time.monotonic()
+                if now >= deadline:
+                    break
+                if candidates and (not pending or now >= nextAttempt):
+                    family, sockaddr = candidates.pop(0)
+                    sock = socket.socket(family, socket.SOCK_STREAM)
+                    sock.setblocking(False)
+                    err = sock.connect_ex(sockaddr)
+                    if err == 0:
+                        return sock
+                    if err not in (errno.EINPROGRESS, errno.EWOULDBLOCK):
+                        sock.close()
+                        lastError = OSError(err, os.strerror(err))
+                        continue
+                    pending[sock] = sockaddr
+                    selector.register(sock, selectors.EVENT_WRITE)
+                    nextAttempt = now + self.attemptDelay
+                wakeUp = min(deadline, nextAttempt) if candidates else deadline
+                for key, _ in selector.select(max(wakeUp - now, 0)):
+                    sock = key.fileobj
+                    selector.unregister(sock)
+                    del pending[sock]
+                    err = sock.getsockopt(socket.SOL_SOCKET, socket.SO_ERROR)
+                    if err == 0:
+                        return sock
+                    sock.close()
+                    lastError = OSError(err, os.strerror(err))
+        finally:
+            selector.close()
+            for sock in pending:
+                sock.close()
+        raise lastError or socket.timeout('timed out connecting to %s:%d' % (host, port))
+
 
-   
 class Proxy(NetworkApplication):
 
-    cache = {}
-    def handle_request(self,connection_sockt):
-        
-        
-        request = connection_sockt.recv(1024).decode()
+    cache = collections.OrderedDict()
+    cacheSize = 128
+    cacheLock = threading.Lock()
+
+    def sendResponse(self, connection_sockt, response, start):
+        for i in range(0, len(response), 1024):
+            connection_sockt.sendall(response[i:i+1024])
+            if i == 0:
+                self.metrics.observe('ttfb_seconds', time.perf_counter() - start)
+        self.metrics.inc('bytes_sent_total', len(response))
+
+    def storeResponse(self, host, response):
+        with self.cacheLock:
+            if host in self.cache:
+                return
+            self.cache[host] = response
+            while len(self.cache) > self.cacheSize:
+                evicted, _ = self.cache.popitem(last=False)
+                self.metrics.inc('cache_evictions_total')
+                log.debug('evicted %s from cache', evicted)
+        log.debug('cached %d bytes for %s', len(response), host)
+
+    def handle_request(self,connection_sockt,accepted):
+        start = time.perf_counter()
+        # time from accept() returning until this handler thread starts running
+        self.metrics.observe('accept_seconds', start - accepted)
+        self.metrics.add('active_connections', 1)
         try:
-            caches_ = False
+            request = connection_sockt.recv(1024)
+            self.metrics.inc('bytes_received_total', len(request))
+            request = request.decode()
+            if self.serveStats(connection_sockt, request.split()[1]):
+                return
             host = request.split()[1].split('/')[2]
             port = 80
             if ':' in host:
                 port = int(host.split(':')[1])
                 host = host.split(':')[0]
-
-            try:
-                if host in self.cache:
-
-                    caches_ = True
-                response = self.cache[host]
-                print(response)
-                for i in range(0, len(response), 1024):
-                    connection_sockt.send(response[i:i+1024])
-                    
-                
+            self.metrics.observe('parse_seconds', time.perf_counter() - start)
+            self.metrics.inc('requests_total')
+
+            with self.cacheLock:
+                response = self.cache.get(host)
+                if response is not None:
+                    self.cache.move_to_end(host)
+            if response is not None:
+                self.metrics.inc('cache_hits_total')
+                log.debug('cache hit for %s (%d bytes)', host, len(response))
+                self.sendResponse(connection_sockt, response, start)
                 connection_sockt.close()
-                
-                
-            except KeyError:
-                pass
-            if caches_ == False:
-
-                proxy_sockt = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+            else:
+                self.metrics.inc('cache_misses_total')
+                connectStart = time.perf_counter()
+                proxy_sockt = self.resolver.openConnection(host, port, 5)
+                self.metrics.observe('upstream_connect_seconds', time.perf_counter() - connectStart)
 
                 proxy_sockt.settimeout(5)
 
-                proxy_sockt.connect((host, port))
-
-
                 proxy_sockt.send(bytes(request, "utf-8"))
                 response = b""
                 while True:
@@ -804,36 +1750,328 @@ class Proxy(NetworkApplication):
                     except socket.timeout:
                         break
 
-                for i in range(0, len(response), 1024):
-                    connection_sockt.send(response[i:i+1024])
+                self.sendResponse(connection_sockt, response, start)
 
                 proxy_sockt.close()
                 connection_sockt.close()
 
-                if host not in self.cache:
-                    self.cache[host] = response
-                    for x in self.cache:
-                        print(x)
-                    for y in self.cache:
-                        print(self.cache[y])
-
+                self.storeResponse(host, response)
 
         except IndexError:
             connection_sockt.close()
+        except OSError as e:
+            # name did not resolve or the origin refused every address
+            log.debug('upstream failed: %s', e)
+            connection_sockt.close()
+        finally:
+            self.metrics.add('active_connections', -1)
+            self.metrics.observe('request_seconds', time.perf_counter() - start)
 
     def __init__(self, args):
         print('Web Proxy starting on port: %i...' % (args.port))
         port = args.port
+        self.metrics = Metrics('proxy')
+        self.resolver = DNSResolver(metrics=self.metrics)
         serverSocket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
         serverSocket.bind(('', args.port))
         serverSocket.listen(1)
         while 1:
 
             ConnectionSocket, addr = serverSocket.accept()
-            t1 = threading.Thread(target = self.handle_request ,args = (ConnectionSocket,))
+            accepted = time.perf_counter()
+            t1 = threading.Thread(target = self.handle_request ,args = (ConnectionSocket, accepted))
             #t1.setDaemon(True)
             t1.start()
 
+class OriginHandler(http.server.BaseHTTPRequestHandler):
+    # Stand-in origin for proxy benchmarks: GET /obj_<size> returns <size> bytes
+
+    def do_GET(self):
+        size = int(self.path.rsplit('_', 1)[1])
+        self.send_response(200)
+        self.send_header('Content-Length', str(size))
+        self.end_headers()
+        self.wfile.write(b'x' * size)
+
+    def log_message(self, format, *args):
+        pass
+
+
+class Benchmark(NetworkApplication):
+
+    def freePort(self) -> int:
+        probe = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        probe.bind(('127.0.0.1', 0))
+        port = probe.getsockname()[1]
+        probe.close()
+        return port
+
+    def startServer(self, command, directory):
+        # Run the server in its own process so it does not share the GIL with the load generator
+        port = self.freePort()
+        process = subprocess.Popen([sys.executable, os.path.abspath(__file__), command, '--port', str(port)],
+                                   cwd=directory, stdout=subprocess.DEVNULL)
+        deadline = time.monotonic() + 10
+        while time.monotonic() < deadline:
+            try:
+                # the servers expect a full request on every connection, so poll /__stats
+                sock = socket.create_connection(('127.0.0.1', port), timeout=1)
+                sock.sendall(b'GET /__stats HTTP/1.0\r\n\r\n')
+                self.readResponse(sock)
+                sock.close()
+                return process, port
+            except OSError:
+                time.sleep(0.05)
+        process.kill()
+        raise RuntimeError('%s server did not start on port %d' % (command, port))
+
+    def readResponse(self, sock) -> bool:
+        # Read one response; returns True if the server left the connection open for reuse
+        data = b''
+        while b'\r\n\r\n' not in data:
+            chunk = sock.recv(65536)
+            if not chunk:
+                return False
+            data += chunk
+        head, body = data.split(b'\r\n\r\n', 1)
+        headers = {}
+        for line in head.split(b'\r\n')[1:]:
+            name, _, value = line.partition(b':')
+            headers[name.strip().lower()] = value.strip().lower()
+        if b'content-length' not in headers:
+            while sock.recv(65536):
+                pass
+            return False
+        remaining = int(headers[b'content-length']) - len(body)
+        while remaining > 0:
+            chunk = sock.recv(min(remaining, 65536))
+            if not chunk:
+                return False
+            remaining -= len(chunk)
+        if head.startswith(b'HTTP/1.0'):
+            return headers.get(b'connection') == b'keep-alive'
+        return headers.get(b'connection') != b'close'
+
+    def generateLoad(self, host, port, path, connections, keepAlive, duration):
+        request = ('GET %s HTTP/1.0\r\nHost: %s\r\nConnection: %s\r\n\r\n'
+                   % (path, host, 'keep-alive' if keepAlive else 'close')).encode()
+        latencies = []
+        errors = []
+        deadline = time.perf_counter() + duration
+
+        def worker():
+            mine = []
+            failures = 0
+            sock = None
+            while time.perf_counter() < deadline:
+                begin = time.perf_counter()
+                try:
+                    if sock is None:
+                        sock = socket.create_connection(('127.0.0.1', port), timeout=10)
+                    sock.sendall(request)
+                    reusable = self.readResponse(sock)
+                except OSError:
+                    failures += 1
+                    reusable = False
+                else:
+                    mine.append(time.perf_counter() - begin)
+                if not (keepAlive and reusable):
+                    if sock is not None:
+                        sock.close()
+                    sock = None
+            if sock is not None:
+                sock.close()
+            latencies.extend(mine)
+            errors.append(failures)
+
+        threads = [threading.Thread(target=worker) for i in range(connections)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        return latencies, sum(errors)
+
+    def residentSetSize(self, pid):
+        # Resident set size of a process in kB (Linux only)
+        try:
+            with open('/proc/%d/status' % pid) as status:
+                for line in status:
+                    if line.startswith('VmRSS:'):
+                        return int(line.split()[1])
+        except OSError:
+            pass
+        return None
+
+    def percentile(self, ordered, fraction):
+        if not ordered:
+            return 0.0
+        return ordered[min(len(ordered) - 1, int(fraction * len(ordered)))] * 1000
+
+    def runScenarios(self, target, process, hostFor, port, pathFor, args):
+        results = []
+        for size in self.parseList(args.sizes, int):
+            for connections in self.parseList(args.connections, int):
+                for keepAlive in self.parseList(args.keepalive, str):
+                    latencies, errors = self.generateLoad(hostFor(size), port, pathFor(size), connections,
+                                                          keepAlive == 'on', args.duration)
+                    latencies.sort()
+                    result = {'target': target, 'connections': connections, 'size': size,
+                              'keepalive': keepAlive, 'requests': len(latencies), 'errors': errors,
+                              'rps': len(latencies) / args.duration,
+                              'p50_ms': self.percentile(latencies, 0.50),
+                              'p99_ms': self.percentile(latencies, 0.99),
+                              'p999_ms': self.percentile(latencies, 0.999),
+                              'rss_kb': self.residentSetSize(process.pid)}
+                    print("%-5s c=%-3d size=%-7d keepalive=%-3s %9.1f req/s  p50 %7.2f ms  p99 %7.2f ms  p999 %7.2f ms  errors %d"
+                          % (target, connections, size, keepAlive, result['rps'], result['p50_ms'],
+                             result['p99_ms'], result['p999_ms'], errors))
+                    results.append(result)
+        return results
+
+    def benchmarkWebServer(self, args, directory):
+        for size in self.parseList(args.sizes, int):
+            with open(os.path.join(directory, 'obj_%d' % size), 'w') as f:
+                f.write('x' * size)
+        process, port = self.startServer('web', directory)
+        try:
+            return self.runScenarios('web', process, lambda size: '127.0.0.1', port,
+                                     lambda size: '/obj_%d' % size, args)
+        finally:
+            process.terminate()
+            process.wait()
+
+    def benchmarkProxy(self, args, directory):
+        # the proxy caches by host, so each object size is served from its own loopback alias
+        sizes = self.parseList(args.sizes, int)
+        hostFor = lambda size: '127.0.0.%d' % (sizes.index(size) + 1)
+        origins = {}
+        for size in sizes:
+            origins[size] = http.server.ThreadingHTTPServer((hostFor(size), 0), OriginHandler)
+            threading.Thread(target=origins[size].serve_forever, daemon=True).start()
+        process, port = self.startServer('proxy', directory)
+        try:
+            return self.runScenarios('proxy', process, hostFor, port,
+                                     lambda size: 'http://%s:%d/obj_%d' % (hostFor(size), origins[size].server_address[1], size),
+                                     args)
+        finally:
+            process.terminate()
+            process.wait()
+            for origin in origins.values():
+                origin.shutdown()
+                origin.server_close()
+
+    def timeOperation(self, name, operation):
+        count, elapsed = timeit.Timer(operation).autorange()
+        best = min(timeit.Timer(operation).repeat(repeat=3, number=count))
+        result = {'name': name, 'ns_per_op': best / count * 1e9}
+        print("%-28s %10.1f ns/op" % (name, result['ns_per_op']))
+        return result
+
+    def benchmarkMicro(self):
+        app = NetworkApplication()
+        results = []
+        for size in (8, 64, 1472):
+            data = bytes(random.getrandbits(8) for i in range(size))
+            results.append(self.timeOperation('checksum_%d' % size, lambda: app.checksum(data)))
+        results.append(self.timeOperation('build_icmp_echo_request', lambda: app.buildICMPEchoRequest(4321)))
+        receiver = ICMPReceiver()
+        probe = app.buildICMPEchoRequest(4321)
+        packet = (struct.pack('!BBHHHBBH4s4s', 0x45, 0, 56, 0, 0, 60, 1, 0, bytes(4), bytes(4)) + struct.pack('!BBHI', 11, 0, 0, 0)
+                  + struct.pack('!BBHHHBBH4s4s', 0x45, 0, 28, 0, 0, 1, 1, 0, bytes(4), bytes(4)) + probe)
+        receiver.buffer[:len(packet)] = packet
+        results.append(self.timeOperation('decode_time_exceeded', lambda: receiver.decode(len(packet), '10.0.0.1')))
+        return results
+
+    def benchmarkProbes(self, args, directory):
+        # Run each probing engine against the simulated network, so no privileges are needed
+        results = []
+        engines = [('traceroute', Traceroute, 'icmp'), ('paris-traceroute', ParisTraceroute, 'icmp'),
+                   ('paris-traceroute', ParisTraceroute, 'udp'), ('campaign', TracerouteCampaign, 'udp')]
+        destinations = ['100.%d.%d.%d' % (64 + i % 8, i % 251, i % 250 + 1) for i in range(args.traces)]
+        destinationFile = os.path.join(directory, 'destinations.txt')
+        with open(destinationFile, 'w') as f:
+            f.write('\n'.join(destinations))
+        for name, engine, protocol in engines:
+            random.seed(args.seed)
+            network = SimulatedNetwork(seed=args.seed, loss=0.01, rateLimit=100)
+            cpuStart = time.process_time()
+            wallStart = time.perf_counter()
+            with open(os.devnull, 'w') as devnull, contextlib.redirect_stdout(devnull):
+                if engine is TracerouteCampaign:
+                    engine(argparse.Namespace(destinations=destinationFile, timeout=1, protocol=protocol,
+                                              start_ttl=6, max_ttl=30, prefix_length=24, concurrency=16,
+                                              transport=network))
+                else:
+                    for destination in destinations:
+                        engine(argparse.Namespace(hostname=destination, timeout=1, protocol=protocol, transport=network))
+            wall = time.perf_counter() - wallStart
+            cpu = time.process_time() - cpuStart
+            result = {'engine': name, 'protocol': protocol, 'traces': args.traces, 'probes': network.probesSent,
+                      'probes_per_second': network.probesSent / wall,
+                      'cpu_us_per_probe': cpu / network.probesSent * 1e6,
+                      'trace_ms': network.elapsed() / args.traces * 1000}
+            print("%-16s %-4s %7d probes %9.0f probes/s  %7.1f us CPU/probe  %8.1f ms/trace (simulated)"
+                  % (name, protocol, network.probesSent, result['probes_per_second'], result['cpu_us_per_probe'],
+                     result['trace_ms']))
+            results.append(result)
+        return results
+
+    def parseList(self, value, cast):
+        return [cast(item.strip()) for item in value.split(',') if item.strip()]
+
+    def compare(self, previous, current):
+        # Print each measurement relative to an earlier run with the same parameters
+        print('Compared with %s:' % previous['timestamp'])
+        key = lambda result: (result['target'], result['connections'], result['size'], result['keepalive'])
+        before = {key(result): result for result in previous.get('load', [])}
+        for result in current['load']:
+            old = before.get(key(result))
+            if old and old['rps']:
+                print("%-5s c=%-3d size=%-7d keepalive=%-3s req/s x%.2f  p99 x%.2f"
+                      % (key(result) + (result['rps'] / old['rps'],
+                                        result['p99_ms'] / old['p99_ms'] if old['p99_ms'] else 0.0)))
+        before = {result['name']: result for result in previous.get('micro', [])}
+        for result in current['micro']:
+            old = before.get(result['name'])
+            if old:
+                print("%-28s time x%.2f" % (result['name'], result['ns_per_op'] / old['ns_per_op']))
+        before = {(result['engine'], result['protocol']): result for result in previous.get('probe', [])}
+        for result in current['probe']:
+            old = before.get((result['engine'], result['protocol']))
+            if old:
+                print("%-16s %-4s probes/s x%.2f  CPU/probe x%.2f"
+                      % (result['engine'], result['protocol'], result['probes_per_second'] / old['probes_per_second'],
+                         result['cpu_us_per_probe'] / old['cpu_us_per_probe']))
+
+    def __init__(self, args):
+        targets = self.parseList(args.targets, str)
+        results = {'timestamp': time.strftime('%Y-%m-%dT%H:%M:%S'), 'python': sys.version.split()[0],
+                   'platform': sys.platform, 'duration': args.duration, 'load': [], 'micro': [], 'probe': []}
+        with tempfile.TemporaryDirectory() as directory:
+            if 'web' in targets:
+                results['load'] += self.benchmarkWebServer(args, directory)
+            if 'proxy' in targets:
+                results['load'] += self.benchmarkProxy(args, directory)
+        if 'micro' in targets:
+            results['micro'] = self.benchmarkMicro()
+        if 'probe' in targets:
+            with tempfile.TemporaryDirectory() as directory:
+                results['probe'] = self.benchmarkProbes(args, directory)
+
+        with open(args.output, 'w') as f:
+            json.dump(results, f, indent=2)
+        print('Results saved to %s' % args.output)
+        if args.compare:
+            with open(args.compare) as f:
+                self.compare(json.load(f), results)
+
+
 if __name__ == "__main__":
     args = setupArgumentParser()
+    logging.basicConfig(level=args.log_level.upper(),
+                        format='%(asctime)s %(threadName)s %(levelname)s %(message)s')
+    if getattr(args, 'format', 'text') != 'text' and not args.output:
+        # stdout carries the records, so the usual text goes to stderr
+        args.stream = sys.stdout.buffer
+        sys.stdout = sys.stderr
     args.func(args)
\ No newline at end of file